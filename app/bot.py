@@ -1,9 +1,22 @@
 import os
+import io
+import time
+import secrets
+import csv
+import asyncio
+import hashlib
 import logging
+import functools
+import multiprocessing
+import concurrent.futures
+from math import isclose
 import sentry_sdk
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ConversationHandler
-from core.analyze_portfolio import generate_analysis_report, validate_kraken_ledger, validate_wallet_csv
+import pandas as pd
+from cachetools import TTLCache
+from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from telegram.request import HTTPXRequest
+from telegram.ext import AIORateLimiter, ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ConversationHandler, PicklePersistence
+from core.analyze_portfolio import generate_analysis_report, validate_kraken_header, validate_wallet_header
 
 # Enable logging
 logging.basicConfig(
@@ -21,74 +34,259 @@ if sentry_dsn:
     )
     logging.info("Sentry initialized.")
 
+def _report_exception(e):
+    # capture_exception is a no-op when Sentry wasn't initialised
+    sentry_sdk.capture_exception(e)
+    logging.exception(e)
+
+def sentry_wrap(fn):
+    """Reports exceptions escaping a handler to Sentry and the log, then re-raises."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            _report_exception(e)
+            raise
+    return wrapper
+
+# Users with a conversation step in flight. Updates are processed concurrently
+# across users (concurrent_updates), but one user's steps must stay in order.
+# In-process only, so a restart never leaves anyone locked out.
+_busy_users = set()
+
+def one_step_per_user(fn):
+    """Ignores a user's conversation update while their previous one is still running."""
+    @functools.wraps(fn)
+    async def wrapper(update, context):
+        user_id = update.effective_user.id
+        if user_id in _busy_users:
+            if update.callback_query:
+                await update.callback_query.answer("⏳ Still working on your previous step...")
+            elif update.message:
+                await update.message.reply_text("⏳ Still working on your previous step, please wait.")
+            return None # conversation state unchanged
+        _busy_users.add(user_id)
+        try:
+            return await fn(update, context)
+        finally:
+            _busy_users.discard(user_id)
+    return wrapper
+
 # States
 UPLOAD_LEDGER, UPLOAD_WALLET = range(2)
 
+# Non-CSV uploads are filtered out before reaching the upload handlers
+CSV_DOCUMENT = filters.Document.FileExtension("csv") | filters.Document.MimeType("text/csv")
+
+# Telegram accepts 2-10 items per album (sendMediaGroup)
+MEDIA_GROUP_LIMIT = 10
+
+def _worker_count():
+    """KRAKEN_WORKERS if set, else the CPUs this process may run on (not the host's total)."""
+    if os.getenv('KRAKEN_WORKERS'):
+        return max(1, int(os.getenv('KRAKEN_WORKERS')))
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # not available on macOS/Windows
+        return os.cpu_count() or 1
+
+# Report generation is CPU-bound (pandas + Matplotlib), so it runs in separate
+# processes to keep the GIL free for the event loop. Workers come from a
+# forkserver: forking this threaded process (event loop, to_thread, httpx) could
+# copy a held lock into the child.
+executor = concurrent.futures.ProcessPoolExecutor(
+    max_workers=_worker_count(),
+    mp_context=multiprocessing.get_context('forkserver')
+)
+
+# Only this much of an upload is decoded to find its header row
+HEADER_SNIFF_BYTES = 4096
+
+# Bytes inspected by the cheap "is this even text/CSV" probe
+CSV_PROBE_BYTES = 512
+CONTROL_BYTES = bytes(b for b in range(32) if b not in (9, 10, 13)) + b'\x7f'
+
+def _cheap_csv_probe(data):
+    """Rejects obvious non-CSV uploads (binary, spreadsheets, HTML pages) from their first bytes."""
+    head = bytes(data[:CSV_PROBE_BYTES]).removeprefix(b'\xef\xbb\xbf')
+    if not head:
+        return False, "Empty CSV file."
+    if b'\x00' in head or len(head) - len(head.translate(None, CONTROL_BYTES)) > len(head) * 0.1:
+        return False, "Not a CSV file (binary content)."
+    first_line = head.split(b'\n', 1)[0]
+    if b',' not in first_line and b';' not in first_line:
+        return False, "Not a CSV file (no delimiter in header)."
+    return True, ""
+
+def _csv_header(data):
+    """Parses the header row from the first bytes of a downloaded CSV."""
+    first_line = bytes(data[:HEADER_SNIFF_BYTES]).split(b'\n', 1)[0]
+    return next(csv.reader(io.StringIO(first_line.decode('utf-8-sig', errors='replace'))), [])
+
+# Conversation state (PicklePersistence) survives restarts. Anchored to this file,
+# not the working directory, so the bot can be started from anywhere.
+STATE_DIR = os.getenv('KRAKEN_STATE_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Session files are written, read and deleted within seconds; docker-compose
+# points KRAKEN_DATA_ROOT at tmpfs (RAM). Without it they stay next to the state,
+# never in a host-wide shared /dev/shm. Either way only the bot's user may enter.
+DATA_ROOT = os.getenv('KRAKEN_DATA_ROOT') or STATE_DIR
+PRIVATE_DIR_MODE = 0o700
+
+# Validated ledgers keyed by Telegram's file_unique_id (stable for identical
+# content), so a re-sent ledger skips the download and validation.
+LEDGER_CACHE_DIR = os.path.join(DATA_ROOT, 'cache')
+ledger_cache = TTLCache(maxsize=256, ttl=3600)
+# Serialises cache updates: the prune below must see every link added so far
+ledger_cache_lock = asyncio.Lock()
+
+async def _download(context, document):
+    file = await context.bot.get_file(document.file_id)
+    return await file.download_as_bytearray()
+
+def _link_file(src, dst):
+    """Hard-links src to dst, returning False if src has gone away."""
+    try:
+        os.link(src, dst)
+    except FileNotFoundError:
+        return False
+    return True
+
+def _cache_ledger(uid, path, live_ids):
+    """Hard-links a validated ledger into the cache dir and drops copies not in live_ids.
+    Callers hold ledger_cache_lock, so live_ids can't miss a concurrent upload's link."""
+    os.makedirs(LEDGER_CACHE_DIR, mode=PRIVATE_DIR_MODE, exist_ok=True)
+    cached_path = os.path.join(LEDGER_CACHE_DIR, f"{uid}.csv")
+    try:
+        os.link(path, cached_path)
+    except FileExistsError:
+        pass
+    with os.scandir(LEDGER_CACHE_DIR) as it:
+        for entry in it:
+            if os.path.splitext(entry.name)[0] not in live_ids:
+                os.unlink(entry.path)
+    return cached_path
+
+def _cleanup_session(session_dir):
+    """Removes a session directory. Sessions only hold the uploaded CSVs, so no recursive walk is needed."""
+    try:
+        with os.scandir(session_dir) as it:
+            for entry in it:
+                os.unlink(entry.path)
+        os.rmdir(session_dir)
+    except FileNotFoundError:
+        pass
+
+def _session_alive(user_data):
+    """True if the session's ledger still exists. tmpfs doesn't survive a restart,
+    even though the persisted conversation still points at it."""
+    ledger_path = user_data.get('ledger_path')
+    return bool(ledger_path) and os.path.isfile(ledger_path)
+
+SESSION_EXPIRED_TEXT = "❌ Your session expired. Please /start again and re-upload your ledger."
+
+def _write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+# Orphan rows shown in the verification message, keeping it under Telegram's
+# 4096-character limit
+ORPHAN_ROWS_LIMIT = 50
+
+def _format_orphans(orphans):
+    """Renders wallet-only transactions as a fixed-width Date/Amount table."""
+    df = pd.DataFrame(orphans[:ORPHAN_ROWS_LIMIT], columns=['date', 'amount'])
+    df['date'] = df['date'].astype(str).str[:10].str.ljust(10)
+    table = df.to_string(index=False, header=['Date', 'Amount'], justify='left',
+                         formatters={'amount': '{:.6f}'.format})
+    header, _, rows = table.partition('\n')
+    return f"{header}\n{'-' * len(header)}\n{rows}"
+
+# Telegram file_ids of charts already uploaded, keyed by a digest of the image
+# bytes. Resending by file_id skips the multipart upload.
+chart_file_ids = TTLCache(maxsize=512, ttl=86400)
+
+# Static replies
+WELCOME_TEXT = (
+    "👋 Welcome to the Crypto Portfolio Bot!\n\n"
+    "I can analyze your Kraken ledger and verify it against your Wallet history.\n"
+    "ℹ️ **Note**: Currently, I only support **Trezor Suite** CSV exports for wallet verification.\n\n"
+    "1️⃣ Please upload your **Kraken Ledger CSV** file to begin."
+)
+
+GLOSSARY_TEXT = (
+    "📊 **REPORT GUIDE**\n\n"
+    "**Asset**: The cryptocurrency symbol (e.e.g., BTC).\n"
+    "**Balance**: Total coins currently in your account.\n"
+    "**Cost Basis**: Total Euros spent to specific coins.\n"
+    "**P/L (€)**: Profit or Loss (Value - Cost Basis).\n"
+    "**Rewards**: Coins earned from passive income.\n"
+    "**Wallet**: Total coins withdrawn to private wallet.\n\n"
+    "**DCA Strategy**:\n"
+    "Buying more at a lower price reduces your average entry price."
+)
+
+ABOUT_TEXT = "Developed by Alireza for fun :)\nv1.0 - Python & Docker"
+
+SKIP_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("Skip Verification", callback_data="skip")]])
+
+@one_step_per_user
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "👋 Welcome to the Crypto Portfolio Bot!\n\n"
-        "I can analyze your Kraken ledger and verify it against your Wallet history.\n"
-        "ℹ️ **Note**: Currently, I only support **Trezor Suite** CSV exports for wallet verification.\n\n"
-        "1️⃣ Please upload your **Kraken Ledger CSV** file to begin.",
-        parse_mode='Markdown'
-    )
+    await update.message.reply_text(WELCOME_TEXT, parse_mode='Markdown')
     return UPLOAD_LEDGER
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    glossary = (
-        "📊 **REPORT GUIDE**\n\n"
-        "**Asset**: The cryptocurrency symbol (e.e.g., BTC).\n"
-        "**Balance**: Total coins currently in your account.\n"
-        "**Cost Basis**: Total Euros spent to specific coins.\n"
-        "**P/L (€)**: Profit or Loss (Value - Cost Basis).\n"
-        "**Rewards**: Coins earned from passive income.\n"
-        "**Wallet**: Total coins withdrawn to private wallet.\n\n"
-        "**DCA Strategy**:\n"
-        "Buying more at a lower price reduces your average entry price."
-    )
-    await update.message.reply_text(glossary, parse_mode='Markdown')
+    await update.message.reply_text(GLOSSARY_TEXT, parse_mode='Markdown')
 
 async def about_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Developed by Alireza for fun :)\nv1.0 - Python & Docker")
-
-import uuid
-import datetime
-import shutil
+    await update.message.reply_text(ABOUT_TEXT)
 
+@sentry_wrap
+@one_step_per_user
 async def receive_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 1. File extension / MIME type is already checked by CSV_DOCUMENT
     document = update.message.document
     
-    # 1. Check File Name/Extension
-    if not document.file_name.lower().endswith('.csv'):
-        await update.message.reply_text("❌ Invalid file format. Please upload a **CSV** file.", parse_mode='Markdown')
-        return UPLOAD_LEDGER
-
-    file = await context.bot.get_file(document.file_id)
+    # A ledger validated within the last hour is reused as-is
+    uid = document.file_unique_id
+    cached_path = ledger_cache.get(uid)
+    data = None
+    
+    if cached_path is None:
+        data = await _download(context, document)
+        
+        # 2. Validate Content (header only, before anything touches the disk)
+        is_valid, error_msg = _cheap_csv_probe(data)
+        if is_valid:
+            is_valid, error_msg = validate_kraken_header(_csv_header(data))
+        if not is_valid:
+            await update.message.reply_text(
+                f"❌ **Invalid File**: {error_msg}\n"
+                "Please check your file and upload a valid **Kraken Ledger CSV**.",
+                parse_mode='Markdown'
+            )
+            return UPLOAD_LEDGER
     
     # Generate Unique Session ID
     user_id = str(update.effective_user.id)
-    session_id = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{str(uuid.uuid4())[:8]}"
+    session_id = f"{time.time_ns():x}_{secrets.token_hex(4)}"
     
     # Create session directory
-    session_dir = os.path.join('data', user_id, session_id)
-    os.makedirs(session_dir, exist_ok=True)
+    session_dir = os.path.join(DATA_ROOT, user_id, session_id)
+    await asyncio.to_thread(os.makedirs, session_dir, mode=PRIVATE_DIR_MODE, exist_ok=True)
     
     context.user_data['session_dir'] = session_dir
     
     filename = os.path.join(session_dir, "ledger.csv")
-    await file.download_to_drive(filename)
-    
-    # 2. Validate Content
-    is_valid, error_msg = validate_kraken_ledger(filename)
-    if not is_valid:
-        # Cleanup and ask retry
-        shutil.rmtree(session_dir)
-        await update.message.reply_text(
-            f"❌ **Invalid File**: {error_msg}\n"
-            "Please check your file and upload a valid **Kraken Ledger CSV**.",
-            parse_mode='Markdown'
-        )
-        return UPLOAD_LEDGER
+    if data is None and not await asyncio.to_thread(_link_file, cached_path, filename):
+        # Cached copy vanished; content was already validated, just fetch it again
+        data = await _download(context, document)
+    if data is not None:
+        await asyncio.to_thread(_write_file, filename, data)
+        async with ledger_cache_lock:
+            live_ids = set(ledger_cache) | {uid}
+            ledger_cache[uid] = await asyncio.to_thread(_cache_ledger, uid, filename, live_ids)
     
     context.user_data['ledger_path'] = filename
     
@@ -96,43 +294,51 @@ async def receive_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "✅ Kraken Ledger verified.\n\n"
         "2️⃣ Now, please upload your **Wallet History CSV** (Trezor Suite export).\n"
         "Or press the button below to skip verification.",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Skip Verification", callback_data="skip")]]),
+        reply_markup=SKIP_MARKUP,
         parse_mode='Markdown'
     )
     return UPLOAD_WALLET
 
+async def reject_non_csv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Returning None keeps the conversation in its current state
+    await update.message.reply_text("❌ Invalid file format. Please upload a **CSV** file.", parse_mode='Markdown')
+
+@sentry_wrap
+@one_step_per_user
 async def skip_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
+    if not _session_alive(context.user_data):
+        await query.edit_message_text(SESSION_EXPIRED_TEXT)
+        context.user_data.clear()
+        return ConversationHandler.END
+    
     context.user_data['wallet_path'] = None
     await query.edit_message_text("Skipping wallet verification. Analyzing portfolio...")
     await run_analysis(query, context)
     return ConversationHandler.END
 
+@sentry_wrap
+@one_step_per_user
 async def receive_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # 1. File extension / MIME type is already checked by CSV_DOCUMENT
     document = update.message.document
     
-    # 1. Check Extension
-    if not document.file_name.lower().endswith('.csv'):
-        await update.message.reply_text("❌ Invalid format. Please upload a **CSV** file.", parse_mode='Markdown')
-        return UPLOAD_WALLET
-
-    file = await context.bot.get_file(document.file_id)
-    
     session_dir = context.user_data.get('session_dir')
-    if not session_dir:
-        await update.message.reply_text("❌ Session error. Please start over.")
+    if not session_dir or not _session_alive(context.user_data):
+        await update.message.reply_text(SESSION_EXPIRED_TEXT)
+        context.user_data.clear()
         return ConversationHandler.END
 
-    filename = os.path.join(session_dir, "wallet.csv")
-    await file.download_to_drive(filename)
+    data = await _download(context, document)
     
-    # 2. Validate Content
-    is_valid, error_msg = validate_wallet_csv(filename)
+    # 2. Validate Content (header only, before anything touches the disk)
+    is_valid, error_msg = _cheap_csv_probe(data)
+    if is_valid:
+        is_valid, error_msg = validate_wallet_header(_csv_header(data))
     if not is_valid:
-        # Delete invalid file but keep session open for retry
-        os.remove(filename)
+        # Keep session open for retry
         await update.message.reply_text(
             f"❌ **Invalid Wallet CSV**: {error_msg}\n"
             "Please upload a valid **Trezor Suite** export or skip this step.",
@@ -140,6 +346,8 @@ async def receive_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return UPLOAD_WALLET
     
+    filename = os.path.join(session_dir, "wallet.csv")
+    await asyncio.to_thread(_write_file, filename, data)
     context.user_data['wallet_path'] = filename
     
     await update.message.reply_text("✅ Wallet CSV verified. Analyzing...")
@@ -155,63 +363,88 @@ async def run_analysis(update_obj, context: ContextTypes.DEFAULT_TYPE):
     session_dir = context.user_data.get('session_dir')
     
     try:
-        # Pass session_dir as output_dir for charts
-        report = generate_analysis_report(ledger_path, wallet_path, output_dir=session_dir)
+        # Last check before handing paths to a worker process (cleanup still runs)
+        if not _session_alive(context.user_data):
+            await message.reply_text(SESSION_EXPIRED_TEXT)
+            return
         
-        # 1. Send Chart Images (Portfolio Summary + DCA Analysis)
-        chart_paths = report.get('chart_paths', [])
-        for chart_path in chart_paths:
-            if os.path.exists(chart_path):
-                await message.reply_photo(photo=open(chart_path, 'rb'))
+        # Charts are rendered in memory (output_dir=None) and come back as PNG bytes
+        report = await asyncio.get_running_loop().run_in_executor(
+            executor,
+            functools.partial(generate_analysis_report, ledger_path, wallet_path, output_dir=None)
+        )
+        
+        # 1. Send Chart Images (Portfolio Summary + DCA Analysis) as one album
+        photos = [(hashlib.blake2b(data, digest_size=16).hexdigest(), data) for data in report.get('chart_images', [])]
+        for i in range(0, len(photos), MEDIA_GROUP_LIMIT):
+            album = photos[i:i + MEDIA_GROUP_LIMIT]
+            media = [chart_file_ids.get(digest, data) for digest, data in album]
+            if len(album) == 1:
+                # Albums need at least 2 items
+                sent = [await message.reply_photo(photo=media[0])]
+            else:
+                sent = await message.reply_media_group(media=[InputMediaPhoto(media=m) for m in media])
+            for (digest, _), msg in zip(album, sent):
+                chart_file_ids[digest] = msg.photo[-1].file_id
             
         # 2. Wallet Verification Result (Keep as text for searchability/copy-paste)
         if 'wallet_verification' in report and report['wallet_verification']:
             verif = report['wallet_verification']
             totals = verif['totals']
-            diff = totals['diff']
             
-            verif_msg = "<b>🛡️ WALLET VERIFICATION</b>\n"
-            verif_msg += f"Kraken Out: <code>{totals['kraken_out']:.6f} BTC</code>\n"
-            verif_msg += f"Wallet In:  <code>{totals['wallet_in']:.6f} BTC</code>\n"
+            lines = [
+                "<b>🛡️ WALLET VERIFICATION</b>\n",
+                f"Kraken Out: <code>{totals['kraken_out']:.6f} BTC</code>\n",
+                f"Wallet In:  <code>{totals['wallet_in']:.6f} BTC</code>\n",
+            ]
             
-            if abs(diff) < 0.0001:
-                 verif_msg += "✅ <b>Totals Match!</b>\n"
+            if isclose(totals['kraken_out'], totals['wallet_in'], abs_tol=1e-4):
+                 lines.append("✅ <b>Totals Match!</b>\n")
             else:
-                 verif_msg += f"⚠️ <b>Mismatch</b>: <code>{diff:+.6f} BTC</code>\n"
+                 lines.append(f"⚠️ <b>Mismatch</b>: <code>{totals['diff']:+.6f} BTC</code>\n")
             
             # Show Mismatches (Orphans)
             if verif.get('orphans'):
-                verif_msg += f"\n⚠️ <b>Found in Wallet ONLY ({len(verif['orphans'])}):</b>\n"
-                verif_msg += "<pre>"
-                verif_msg += f"{'Date':<12} {'Amount':<10}\n"
-                verif_msg += "-" * 24 + "\n"
-                for t in verif['orphans']:
-                    verif_msg += f"{str(t['date'])[:10]:<12} {t['amount']:<10.6f}\n"
-                verif_msg += "</pre>"
+                orphans = verif['orphans']
+                lines.extend([
+                    f"\n⚠️ <b>Found in Wallet ONLY ({len(orphans)}):</b>\n",
+                    "<pre>",
+                    _format_orphans(orphans),
+                    "\n",
+                ])
+                if len(orphans) > ORPHAN_ROWS_LIMIT:
+                    lines.append(f"... and {len(orphans) - ORPHAN_ROWS_LIMIT} more\n")
+                lines.append("</pre>")
                 
-            await message.reply_text(verif_msg, parse_mode='HTML')
+            await message.reply_text(''.join(lines), parse_mode='HTML')
 
     except Exception as e:
+        # Not re-raised: the user has been told and the conversation still ends
         await message.reply_text(f"❌ Error during analysis: {str(e)}")
-        if sentry_dsn:
-            sentry_sdk.capture_exception(e)
-        logging.error(e)
+        _report_exception(e)
         
     finally:
-        # Cleanup
-        if session_dir and os.path.exists(session_dir):
+        # Cleanup (_cleanup_session already tolerates a missing directory)
+        if session_dir:
             try:
-                shutil.rmtree(session_dir)
+                await asyncio.to_thread(_cleanup_session, session_dir)
                 logging.info(f"Cleaned up session: {session_dir}")
             except Exception as cleanup_error:
                 logging.error(f"Failed to cleanup {session_dir}: {cleanup_error}")
+        context.user_data.clear()
 
+@sentry_wrap
+@one_step_per_user
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Analysis cancelled. Type /start to try again.", reply_markup=ReplyKeyboardRemove())
     # Cleanup if needed
     session_dir = context.user_data.get('session_dir')
-    if session_dir and os.path.exists(session_dir):
-         shutil.rmtree(session_dir, ignore_errors=True)
+    if session_dir:
+        try:
+            await asyncio.to_thread(_cleanup_session, session_dir)
+        except OSError as cleanup_error:
+            logging.error(f"Failed to cleanup {session_dir}: {cleanup_error}")
+    context.user_data.clear()
     return ConversationHandler.END
 
 if __name__ == '__main__':
@@ -220,23 +453,69 @@ if __name__ == '__main__':
         print("Error: TELEGRAM_TOKEN environment variable not set.")
         exit(1)
         
-    application = ApplicationBuilder().token(token).build()
+    # Pace outbound calls to Telegram's flood limits instead of tripping RetryAfter
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=30, overall_time_period=1,
+        group_max_rate=20, group_time_period=60,
+        max_retries=3
+    )
+    # Keep conversation state and session paths across restarts
+    os.makedirs(STATE_DIR, exist_ok=True)
+    # Users' ledgers live under DATA_ROOT: make it private even if it already existed
+    os.makedirs(DATA_ROOT, mode=PRIVATE_DIR_MODE, exist_ok=True)
+    os.chmod(DATA_ROOT, PRIVATE_DIR_MODE)
+    persistence = PicklePersistence(filepath=os.path.join(STATE_DIR, 'bot_state.pickle'))
+    
+    # Persistent HTTP/2 connections to api.telegram.org, so file downloads and
+    # uploads share a pool instead of paying a TLS handshake each
+    request = HTTPXRequest(connection_pool_size=20, pool_timeout=5, read_timeout=30, http_version="2")
+    get_updates_request = HTTPXRequest(http_version="2")
+    
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .rate_limiter(rate_limiter)
+        .persistence(persistence)
+        # Handlers run concurrently, so one user's report never holds up another's
+        # upload and the report pool can work on several at once
+        .concurrent_updates(True)
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
         states={
-            UPLOAD_LEDGER: [MessageHandler(filters.Document.ALL, receive_ledger)],
+            UPLOAD_LEDGER: [
+                MessageHandler(CSV_DOCUMENT, receive_ledger),
+                MessageHandler(filters.Document.ALL, reject_non_csv)
+            ],
             UPLOAD_WALLET: [
-                MessageHandler(filters.Document.ALL, receive_wallet),
+                MessageHandler(CSV_DOCUMENT, receive_wallet),
+                MessageHandler(filters.Document.ALL, reject_non_csv),
                 CallbackQueryHandler(skip_callback, pattern='^skip$')
             ],
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='portfolio_conversation',
+        persistent=True
     )
 
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('about', about_command))
 
+    # Telegram pushes updates to us when a public URL is configured;
+    # fall back to long polling for local runs.
+    public_url = os.getenv('PUBLIC_URL')
     print("Bot is running...")
-    application.run_polling()
+    if public_url:
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv('PORT', 8443)),
+            url_path=token,
+            webhook_url=f"{public_url.rstrip('/')}/{token}"
+        )
+    else:
+        application.run_polling()
@@ -1,25 +1,61 @@
+import io
 import csv
 import collections
+import bisect
 import urllib.request
 import json
 import statistics
+import stat
 from datetime import datetime
+from dataclasses import dataclass, fields
+from itertools import starmap
+from operator import attrgetter, itemgetter
+from functools import lru_cache
 import sys
 import os
 import ssl
+import time
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-# Fix for SSL: CERTIFICATE_VERIFY_FAILED
 try:
-    _create_unverified_https_context = ssl._create_unverified_context
-except AttributeError:
-    pass
-else:
-    ssl._create_default_https_context = _create_unverified_https_context
+    import pandas as pd
+except ImportError:
+    pd = None
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+try:
+    import certifi
+except ImportError:
+    certifi = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from cachetools import TTLCache
+except ImportError:
+    TTLCache = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
 
 # --- Configuration ---
 # Valid assets to track (ignoring small dust or fiat unless specified)
-TRACKED_ASSETS = ['BTC', 'ETH', 'SOL', 'PEPE', 'DOT', 'ADA', 'XRP', 'LTC', 'USDG', 'DOGE'] 
-FIAT_ASSETS = ['EUR', 'EUR.HOLD', 'USD']
+TRACKED_ASSETS = frozenset(['BTC', 'ETH', 'SOL', 'PEPE', 'DOT', 'ADA', 'XRP', 'LTC', 'USDG', 'DOGE'])
+FIAT_ASSETS = frozenset(['EUR', 'EUR.HOLD', 'USD'])
+REWARD_TYPES = frozenset(['earn', 'reward'])
 
 # ANSI Colors
 class Color:
@@ -37,53 +73,83 @@ def print_colored(text, color):
     print(f"{color}{text}{Color.ENDC}")
 
 # --- Data Structures ---
-Transaction = collections.namedtuple('Transaction', ['txid', 'refid', 'time', 'type', 'subtype', 'aclass', 'asset', 'amount', 'fee', 'balance'])
+@dataclass(slots=True)
+class Transaction:
+    txid: str
+    refid: str
+    time: str
+    type: str
+    subtype: str
+    aclass: str
+    asset: str
+    amount: float
+    fee: float
+    balance: float
+
+TRANSACTION_FIELDS = tuple(f.name for f in fields(Transaction))
+
+@dataclass(slots=True)
+class AssetRow:
+    """Running per-asset totals built by analyze_portfolio."""
+    amount: float = 0.0
+    fees_paid: float = 0.0
+    rewards: float = 0.0
+    buy_cost: float = 0.0
+    buy_amt: float = 0.0
+    withdrawn: float = 0.0
+
+def validate_kraken_header(fieldnames):
+    """Checks a parsed CSV header row for the required Kraken columns."""
+    required_columns = {'txid', 'refid', 'time', 'type', 'asset', 'amount'}
+    if not fieldnames:
+        return False, "Empty CSV file."
+    
+    # Normalize fieldnames to lowercase/stripped for comparison
+    headers = {h.strip().replace('"', '').lower() for h in fieldnames if h}
+    missing = required_columns - headers
+    
+    if missing:
+        return False, f"Missing columns: {', '.join(missing)}"
+    
+    return True, "Valid Kraken Ledger"
+
+def _read_header_fields(filepath, encoding):
+    """Split the first line on commas; header names never contain quoted commas."""
+    with open(filepath, mode='r', encoding=encoding) as csvfile:
+        header_line = csvfile.readline()
+    if not header_line:
+        return []
+    return header_line.split(',')
 
 def validate_kraken_ledger(filepath):
     """Checks if the CSV has the required Kraken columns."""
-    required_columns = {'txid', 'refid', 'time', 'type', 'asset', 'amount'}
     try:
-        with open(filepath, mode='r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile)
-            if not reader.fieldnames:
-                return False, "Empty CSV file."
-            
-            # Normalize fieldnames to lowercase/stripped for comparison
-            headers = {h.strip().replace('"', '').lower() for h in reader.fieldnames if h}
-            missing = required_columns - headers
-            
-            if missing:
-                return False, f"Missing columns: {', '.join(missing)}"
-            
-            return True, "Valid Kraken Ledger"
+        return validate_kraken_header(_read_header_fields(filepath, 'utf-8-sig'))
     except Exception as e:
         return False, str(e)
 
-def validate_wallet_csv(filepath):
-    """Checks if the CSV has the required Wallet export columns."""
+def validate_wallet_header(fieldnames):
+    """Checks a parsed CSV header row for the required Wallet export columns."""
     # Trezor Suite export usually has: Date, Type, Amount (in some form)
-    # Based on load_wallet_csv, we need 'Type', 'Amount', 'Date' (case sensitive in load function but lets be flexible here or strict based on usage)
     # The load function uses: row.get('Type'), row.get('Amount'), row.get('Date')
     
     required_columns = {'Date', 'Type', 'Amount'} # Case sensitive matching load_wallet_csv
+    if not fieldnames:
+        return False, "Empty CSV file."
+    
+    headers = {h.strip().replace('"', '') for h in fieldnames if h}
+    
+    # Wallet exports vary, so require ALL of the columns load_wallet_csv reads
+    missing = required_columns - headers
+    if missing:
+        return False, f"Missing columns: {', '.join(missing)}. Ensure this is a Trezor Suite export."
+        
+    return True, "Valid Wallet CSV"
+
+def validate_wallet_csv(filepath):
+    """Checks if the CSV has the required Wallet export columns."""
     try:
-        with open(filepath, mode='r', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            if not reader.fieldnames:
-                 return False, "Empty CSV file."
-            
-            headers = {h.strip().replace('"', '') for h in reader.fieldnames if h}
-            
-            # Check for intersection. Since wallet exports vary, we check if we have matching subsets
-            # Or strict? The user said "Trezor Suite CSV exports".
-            # Let's check if ALL required are present.
-            
-            missing = required_columns - headers
-            if missing:
-                return False, f"Missing columns: {', '.join(missing)}. Ensure this is a Trezor Suite export."
-                
-            return True, "Valid Wallet CSV"
-            
+        return validate_wallet_header(_read_header_fields(filepath, 'utf-8-sig'))
     except Exception as e:
         return False, str(e)
 
@@ -93,35 +159,216 @@ def parse_float(value):
     except (ValueError, TypeError):
         return 0.0
 
+LEDGER_NUMERIC_COLUMNS = ('amount', 'fee', 'balance')
+LEDGER_OPTIONAL_COLUMNS = frozenset(['subtype']) # read as '' when the export lacks it
+
+def _ledger_header(filepath):
+    """Header names stripped and unquoted; raises ValueError when a required column is missing."""
+    header = [h.replace('"', '').strip() for h in _read_header_fields(filepath, 'utf-8-sig')]
+    missing = [c for c in TRANSACTION_FIELDS if c not in header and c not in LEDGER_OPTIONAL_COLUMNS]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
+    return header
+
+def _load_csv_pandas(filepath):
+    """Parses the ledger with pandas' C reader; numeric columns never become Python objects until the end."""
+    df = pd.read_csv(
+        filepath,
+        encoding='utf-8-sig',
+        header=0,
+        names=_ledger_header(filepath), # normalised names replace the file's header row
+        usecols=lambda c: c in TRANSACTION_FIELDS,
+        dtype={c: object for c in TRANSACTION_FIELDS if c not in LEDGER_NUMERIC_COLUMNS},
+        keep_default_na=False,
+        na_values={c: [''] for c in LEDGER_NUMERIC_COLUMNS},
+    )
+    df = df.reindex(columns=TRANSACTION_FIELDS) # only ever adds an optional column
+    for col in TRANSACTION_FIELDS:
+        if col in LEDGER_NUMERIC_COLUMNS:
+            # Same as parse_float: anything unparseable counts as 0.0
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0)
+        else:
+            # Trimmed both sides, like the csv path
+            df[col] = df[col].fillna('').str.strip()
+    return list(starmap(Transaction, zip(*(df[col].tolist() for col in TRANSACTION_FIELDS))))
+
+def _load_csv_arrow(filepath):
+    """Parses the ledger with pyarrow's multithreaded reader; strings are trimmed like the csv path."""
+    # Normalised names replace the file's header row (skipping it also skips the BOM)
+    table = pacsv.read_csv(filepath, read_options=pacsv.ReadOptions(column_names=_ledger_header(filepath), skip_rows=1),
+                           convert_options=pacsv.ConvertOptions(
+        include_columns=list(TRANSACTION_FIELDS),
+        include_missing_columns=True, # only ever an optional column, see _ledger_header
+        column_types={c: pa.float64() if c in LEDGER_NUMERIC_COLUMNS else pa.string() for c in TRANSACTION_FIELDS},
+        null_values=[''],
+        strings_can_be_null=False,
+    ))
+    columns = [
+        pc.fill_null(table.column(col), 0.0).to_pylist() if col in LEDGER_NUMERIC_COLUMNS
+        else pc.utf8_trim_whitespace(pc.fill_null(table.column(col), '')).to_pylist()
+        for col in TRANSACTION_FIELDS
+    ]
+    return list(starmap(Transaction, zip(*columns)))
+
 def load_csv(filepath):
-    transactions = []
-    try:
-        with open(filepath, mode='r', encoding='utf-8-sig') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # Basic cleaning
-                for key, val in row.items():
-                    row[key] = val.strip().replace('"', '')
-                
-                t = Transaction(
-                    txid=row['txid'],
-                    refid=row['refid'],
-                    time=row['time'],
-                    type=row['type'],
-                    subtype=row['subtype'],
-                    aclass=row['aclass'],
-                    asset=row['asset'],
-                    amount=parse_float(row['amount']),
-                    fee=parse_float(row['fee']),
-                    balance=parse_float(row['balance'])
-                )
-                transactions.append(t)
-    except FileNotFoundError:
-        print_colored(f"Error: File '{filepath}' not found.", Color.FAIL)
-        sys.exit(1)
+    """
+    Parses a Kraken ledger into Transactions. Raises FileNotFoundError for a
+    missing file (it also runs inside bot workers, so it never exits).
+    """
+    if pa is not None:
+        try:
+            return _load_csv_arrow(filepath)
+        except pa.ArrowInvalid:
+            pass # Unparseable numbers: let pandas/csv coerce them to 0.0
+    if pd is not None:
+        return _load_csv_pandas(filepath)
+
+    # Fallback without pyarrow/pandas
+    with open(filepath, mode='r', encoding='utf-8-sig') as csvfile:
+        reader = csv.reader(csvfile)
+        header = _ledger_header(filepath)
+        next(reader, None)
+        # Column offsets resolved once; the csv engine already unquotes fields
+        i_txid, i_refid, i_time, i_type, i_aclass, i_asset, i_amount, i_fee, i_balance = (
+            header.index(field) for field in TRANSACTION_FIELDS if field != 'subtype')
+        i_subtype = header.index('subtype') if 'subtype' in header else None
+        transactions = [
+            Transaction(
+                row[i_txid].strip(), row[i_refid].strip(), row[i_time].strip(), row[i_type].strip(),
+                row[i_subtype].strip() if i_subtype is not None else '', row[i_aclass].strip(), row[i_asset].strip(),
+                parse_float(row[i_amount]), parse_float(row[i_fee]), parse_float(row[i_balance]),
+            )
+            for row in reader if row
+        ]
     return transactions
 
-def get_crypto_prices(assets):
+# Pair names as Kraken returns them in Ticker results, for pairs requested under
+# another name (generic ASSET+'EUR', altname) -> our asset symbol
+KRAKEN_PAIR_ALIASES = {
+    'XXBTZEUR': 'BTC', 'XBTEUR': 'BTC', 'BTCEUR': 'BTC',
+    'XETHZEUR': 'ETH', 'ETHEUR': 'ETH',
+    'XLTCZEUR': 'LTC', 'LTCEUR': 'LTC',
+    'XDGEUR': 'DOGE', 'DOGEEUR': 'DOGE',
+    'XXRPZEUR': 'XRP', 'XRPEUR': 'XRP',
+    'XXLMZEUR': 'XLM', 'XLMEUR': 'XLM',
+    'XXMRZEUR': 'XMR', 'XMREUR': 'XMR',
+    'XETCZEUR': 'ETC', 'ETCEUR': 'ETC',
+    'XZECZEUR': 'ZEC', 'ZECEUR': 'ZEC',
+}
+
+PRICE_CACHE_TTL = 60 # seconds a cached ticker response stays fresh
+PRICE_FETCH_WORKERS = 8 # concurrent per-pair requests; keeps us under Kraken's public rate limit
+
+# Both work on bytes (API bodies, the price cache file); no intermediate str
+_json_loads = orjson.loads if orjson is not None else json.loads
+_json_dumps = orjson.dumps if orjson is not None else (lambda obj: json.dumps(obj).encode())
+
+# In-process layer over the disk cache: repeat calls in a worker skip even the file read
+_price_memo = TTLCache(maxsize=256, ttl=PRICE_CACHE_TTL) if TTLCache is not None else None
+
+# Per-user and private (0700): a shared temp dir would let another account
+# plant prices under the predictable file names
+PRICE_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'krakenlens')
+
+def _owned_by_us(st):
+    return not hasattr(os, 'getuid') or st.st_uid == os.getuid()
+
+def _price_cache_path(pairs):
+    """Cache file for this pair set, or None when the cache dir can't be made private."""
+    try:
+        os.makedirs(PRICE_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(PRICE_CACHE_DIR)
+        if not stat.S_ISDIR(st.st_mode) or not _owned_by_us(st):
+            return None
+        if st.st_mode & 0o077:
+            os.chmod(PRICE_CACHE_DIR, 0o700)
+    except OSError:
+        return None
+    cache_key = hashlib.sha1(','.join(sorted(pairs)).encode()).hexdigest()
+    return os.path.join(PRICE_CACHE_DIR, f'kraken_ticker_{cache_key}.json')
+
+def _read_price_cache(cache_path):
+    """Return cached prices if the file is ours and younger than PRICE_CACHE_TTL, else None."""
+    if cache_path is None:
+        return None
+    try:
+        with open(os.open(cache_path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0)), 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not _owned_by_us(st) or time.time() - st.st_mtime > PRICE_CACHE_TTL:
+                return None
+            return _json_loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+def _write_price_cache(cache_path, prices):
+    if cache_path is None:
+        return
+    # Unique temp file, then rename, so concurrent readers never see a partial file
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+    except OSError:
+        return
+    try:
+        with open(fd, 'wb') as f:
+            f.write(_json_dumps(prices))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+HTTP_HEADERS = {'User-Agent': 'Mozilla/5.0'}
+# Seconds; a stalled Kraken connection must not hang the report indefinitely
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 10
+
+# Verified TLS against certifi's CA bundle (fixes CERTIFICATE_VERIFY_FAILED on systems
+# without a usable CA store). Behind a TLS-intercepting proxy, point SSL_CERT_FILE at its CA.
+_SSL_CONTEXT = ssl.create_default_context(cafile=os.getenv('SSL_CERT_FILE') or (certifi.where() if certifi else None))
+
+# One keep-alive pool for every Kraken call, so the TLS handshake is paid once
+# per connection rather than once per request. Sized for the concurrent fallback.
+_http = urllib3.PoolManager(
+    maxsize=8, headers=HTTP_HEADERS, ssl_context=_SSL_CONTEXT,
+    timeout=urllib3.Timeout(connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT),
+) if urllib3 is not None else None
+
+def _get_json(url):
+    """GET a Kraken public endpoint and decode the JSON body."""
+    if _http is not None:
+        response = _http.request('GET', url)
+        if response.status >= 400:
+            raise urllib3.exceptions.HTTPError(f"HTTP Error {response.status}: {response.reason}")
+        return _json_loads(response.data)
+    req = urllib.request.Request(url, headers=HTTP_HEADERS)
+    with urllib.request.urlopen(req, context=_SSL_CONTEXT, timeout=HTTP_READ_TIMEOUT) as response:
+        return _json_loads(response.read())
+
+def _fetch_ticker(pair):
+    """Fetch a single Kraken ticker; returns (pair, data, error) instead of raising."""
+    try:
+        return pair, _get_json(f"https://api.kraken.com/0/public/Ticker?pair={pair}"), None
+    except Exception as e:
+        return pair, None, e
+
+def _fetch_batch(pairs, reverse_map):
+    """One Ticker request for all pairs; raises ValueError when Kraken rejects the batch."""
+    data = _get_json(f"https://api.kraken.com/0/public/Ticker?pair={','.join(pairs)}")
+    if 'error' in data and data['error']:
+        # If batch fails, try individual
+        print_colored(f"Batch API failed ({data['error']}), trying individual pairs...", Color.WARNING)
+        raise ValueError("Batch failed")
+
+    prices = {}
+    # Kraken may answer with the legacy or alt name of a generic pair
+    for pair, details in data.get('result', {}).items():
+        found_asset = reverse_map.get(pair) or KRAKEN_PAIR_ALIASES.get(pair)
+        if found_asset:
+            prices[found_asset] = float(details['c'][0])
+    return prices
+
+def get_crypto_prices(assets, force_refresh=False):
     # Kraken API public ticker
     # Mapping some common names to Kraken pairs (simple mapping)
     # Note: Kraken uses specific pair names (e.g., XXBTZEUR for BTC/EUR)
@@ -156,50 +403,58 @@ def get_crypto_prices(assets):
     if not pairs:
         return {}
 
+    memo_key = tuple(sorted(pairs))
+    cache_path = _price_cache_path(pairs)
+    if not force_refresh:
+        cached = _price_memo.get(memo_key) if _price_memo is not None else None
+        if cached is None:
+            cached = _read_price_cache(cache_path)
+        if cached is not None:
+            if _price_memo is not None:
+                _price_memo[memo_key] = cached
+            return dict(cached)
+
     # Try batch first
     try:
-        url = f"https://api.kraken.com/0/public/Ticker?pair={','.join(pairs)}"
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read().decode())
-            if 'error' in data and data['error']:
-                # If batch fails, try individual
-                print_colored(f"Batch API failed ({data['error']}), trying individual pairs...", Color.WARNING)
-                raise ValueError("Batch failed")
-            
-            if 'result' in data:
-                # Process batch results (same logic as before)
-                for pair, details in data['result'].items():
-                     price = float(details['c'][0])
-                     found_asset = reverse_map.get(pair)
-                     if not found_asset:
-                         for p_req, a_req in reverse_map.items():
-                            if p_req in pair or pair in p_req:
-                                found_asset = a_req
-                                break
-                     if found_asset:
-                         prices[found_asset] = price
+        prices.update(_fetch_batch(pairs, reverse_map))
 
     except Exception:
-        # Fallback: Individual Requests
-        for asset in assets:
-            pair = mapping.get(asset, asset + 'EUR')
-            url = f"https://api.kraken.com/0/public/Ticker?pair={pair}"
+        # Kraken rejects the whole batch over one unknown pair, and only the
+        # generic guesses can be unknown: re-batch the mapped pairs, then fetch
+        # just the guesses on their own. Everything goes individually otherwise.
+        individual = {asset: mapping.get(asset, asset + 'EUR') for asset in assets}
+        known = [pair for pair in pairs if pair in mapping.values()]
+        if known and len(known) < len(pairs):
             try:
-                req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-                with urllib.request.urlopen(req) as response:
-                    data = json.loads(response.read().decode())
-                    if 'result' in data:
-                        for _, details in data['result'].items():
-                            prices[asset] = float(details['c'][0])
-                            print(f"Fetched {asset}: €{prices[asset]}")
-            except Exception as e:
-                print(f"Failed to fetch {asset} ({pair}): {e}")
+                prices.update(_fetch_batch(known, reverse_map))
+                individual = {asset: pair for asset, pair in individual.items() if asset not in mapping}
+            except Exception:
+                pass
+
+        # Fallback: Individual Requests, fired concurrently (I/O bound, one RTT total)
+        with ThreadPoolExecutor(max_workers=min(PRICE_FETCH_WORKERS, len(individual))) as pool:
+            results = pool.map(_fetch_ticker, individual.values())
+            for asset, (pair, data, error) in zip(individual, results):
+                if error is not None:
+                    print(f"Failed to fetch {asset} ({pair}): {error}")
+                    continue
+                if 'result' in data:
+                    for _, details in data['result'].items():
+                        prices[asset] = float(details['c'][0])
+                        print(f"Fetched {asset}: €{prices[asset]}")
 
+    if prices:
+        _write_price_cache(cache_path, prices)
+        if _price_memo is not None:
+            _price_memo[memo_key] = dict(prices)
     return prices
 
 def analyze_portfolio(transactions):
-    portfolio = collections.defaultdict(lambda: {'amount': 0.0, 'fees_paid': 0.0, 'rewards': 0.0, 'buy_cost': 0.0, 'buy_amt': 0.0, 'withdrawn': 0.0})
+    """
+    Returns (portfolio, assets_held): per-asset totals, plus the non-fiat
+    assets still held or moved to a wallet (the ones worth pricing), as a sorted tuple.
+    """
+    portfolio = collections.defaultdict(AssetRow)
     
     # Group by RefID to handle trades (Source Currency -> Target Currency)
     # A trade usually involves two rows with same RefID: one negative amount (sell), one positive (buy).
@@ -208,42 +463,39 @@ def analyze_portfolio(transactions):
     # Simplification: We will track net EUR flow for "Cost Basis".
     # For every Crypto 'Buy' (positive amount), we look for corresponding EUR 'Spend' (negative amount).
     
-    tx_by_refid = collections.defaultdict(list)
-    for t in transactions:
-        tx_by_refid[t.refid].append(t)
+    # Buy legs per refid, collected during the single walk: [crypto_tx, fiat_tx]
+    # (last matching row of each kind wins)
+    legs = {}
         
     # 1. Total Holdings & Rewards
     for t in transactions:
         if t.asset in FIAT_ASSETS:
-             portfolio['EUR']['amount'] += t.amount # Net EUR flow
+             portfolio['EUR'].amount += t.amount # Net EUR flow
+             if t.amount < 0:
+                 legs.setdefault(t.refid, [None, None])[1] = t
              continue
 
         if t.asset not in TRACKED_ASSETS and t.amount < 0.0000001: continue # Skip dust
         
-        portfolio[t.asset]['amount'] += t.amount
-        portfolio[t.asset]['fees_paid'] += t.fee
+        position = portfolio[t.asset]
+        position.amount += t.amount
+        position.fees_paid += t.fee
         
-        if t.type in ['earn', 'reward']:
-             portfolio[t.asset]['rewards'] += t.amount
+        if t.type in REWARD_TYPES:
+             position.rewards += t.amount
              
         # Track withdrawals (Moved to Wallet)
         if t.type == 'withdrawal':
-            portfolio[t.asset]['withdrawn'] += abs(t.amount)
+            position.withdrawn += abs(t.amount)
 
-    # 2. Approximate Cost Basis (EUR Spent on Buys)
-    # We look at 'trade' groups.
-    for refid, group in tx_by_refid.items():
         # Identify if this is a buy order
         # Criteria: Positive Crypto Amount AND Negative Fiat Amount
-        crypto_tx = None
-        fiat_tx = None
-        
-        for t in group:
-            if t.asset in TRACKED_ASSETS and t.amount > 0 and t.type == 'trade':
-                crypto_tx = t
-            if t.asset in FIAT_ASSETS and t.amount < 0:
-                fiat_tx = t
-        
+        if t.type == 'trade' and t.amount > 0 and t.asset in TRACKED_ASSETS:
+            legs.setdefault(t.refid, [None, None])[0] = t
+
+    # 2. Approximate Cost Basis (EUR Spent on Buys)
+    # Only refids that produced a leg are visited, not the whole ledger again.
+    for crypto_tx, fiat_tx in legs.values():
         if crypto_tx and fiat_tx:
             # We found a buy formatted transaction
             
@@ -256,23 +508,36 @@ def analyze_portfolio(transactions):
             cost = abs(fiat_tx.amount) 
             
             # Add to the total cost for this asset
-            portfolio[crypto_tx.asset]['buy_cost'] += cost
+            portfolio[crypto_tx.asset].buy_cost += cost
             
             # --- AVERAGE PRICE LOGIC ---
             # To calculate the true "Average Buy Price", we must track the TOTAL amount
             # of coins we ever bought, regardless of whether we sold or withdrew them later.
             # Avg Price = Total EUR Spent / Total Coins Bought
-            portfolio[crypto_tx.asset]['buy_amt'] += crypto_tx.amount 
+            portfolio[crypto_tx.asset].buy_amt += crypto_tx.amount 
 
-    return portfolio
+    assets_held = tuple(sorted(a for a, d in portfolio.items() if (d.amount > 0 or d.withdrawn > 0) and a not in FIAT_ASSETS))
+    return portfolio, assets_held
 
-def run_dca_scenarios(asset, current_holdings, cost_basis, total_bought, current_price, scenarios=[100, 200, 500, 1000, 2000], print_output=True):
-    if print_output:
-        print_colored(f"\n--- Scenario Analysis: Averaging Down {asset} ---", Color.CYAN)
-    
-    # --- CALCULATION ---
+DCA_FEE_RATE = 0.0026 # Assume 0.26% fee on new purchases
+
+@lru_cache(maxsize=32)
+def _dca_kernel(cost_basis, total_bought, current_price, scenarios):
+    """Pure scenario math, memoized: returns avg_price and (invest, bought, new_total, new_avg, reduction) rows."""
     # Avg Price = Total EUR Spent (cost_basis) / Total Coins Bought (total_bought)
     avg_price = cost_basis / total_bought if total_bought > 0 else 0
+    rows = []
+    for invest_amount in scenarios:
+        amount_bought = (invest_amount - invest_amount * DCA_FEE_RATE) / current_price
+        new_total_bought = total_bought + amount_bought 
+        new_avg_price = (cost_basis + invest_amount) / new_total_bought
+        reduction = ((avg_price - new_avg_price) / avg_price) * 100
+        rows.append((invest_amount, amount_bought, new_total_bought, new_avg_price, reduction))
+    return avg_price, tuple(rows)
+
+def run_dca_scenarios(asset, current_holdings, cost_basis, total_bought, current_price, scenarios=(100, 200, 500, 1000, 2000), print_output=True):
+    # --- CALCULATION ---
+    avg_price, rows = _dca_kernel(cost_basis, total_bought, current_price, tuple(scenarios))
     
     dca_data = {
         'asset': asset,
@@ -284,74 +549,129 @@ def run_dca_scenarios(asset, current_holdings, cost_basis, total_bought, current
         'scenarios': []
     }
 
-    if print_output:
-        print(f"Total BTC Bought:    {total_bought:,.6f} (This is the sum of all your 'Buy' orders)")
-        print(f"Total Cost Basis:    €{cost_basis:,.2f}  (This is the sum of all EUR spent on those orders)")
-        print(f"Current Avg Price:   {Color.BOLD}€{avg_price:,.2f}{Color.ENDC}  (Cost Basis / Total Bought)")
-        print(f"Current Market Price: {Color.BOLD}€{current_price:,.2f}{Color.ENDC}")
-        
-        if dca_data['is_profit']:
-            print_colored("You are currently in profit on your historical buys. Averaging UP.", Color.GREEN)
-        else:
-            print_colored("You are currently in loss on your historical buys. Averaging DOWN.", Color.WARNING)
-
-        print("\nImpact of new purchases:")
-        print(f"{'Invest (€)':<12} | {'Buy Amount':<12} | {'New Total BTC':<15} | {'New Avg Price':<15} | {'Reduction %':<10}")
-        print("-" * 75)
-    
     # Data for plotting
     plot_data = [] # (investment, new_avg_price)
     plot_data.append((0, avg_price))
     
-    for invest_amount in scenarios:
-        # Assume 0.26% fee
-        fee = invest_amount * 0.0026
-        net_invest = invest_amount - fee
-        amount_bought = net_invest / current_price
-        
-        new_total_cost = cost_basis + invest_amount
-        new_total_bought = total_bought + amount_bought 
-        
-        new_avg_price = new_total_cost / new_total_bought
-        
-        reduction = ((avg_price - new_avg_price) / avg_price) * 100
-        
-        scenario_result = {
+    for invest_amount, amount_bought, new_total_bought, new_avg_price, reduction in rows:
+        dca_data['scenarios'].append({
             'investment': invest_amount,
             'buy_amount': amount_bought,
             'new_total_btc': new_total_bought,
             'new_avg_price': new_avg_price,
             'reduction_percent': reduction
-        }
-        dca_data['scenarios'].append(scenario_result)
-        
-        if print_output:
-            color = Color.GREEN if new_avg_price < avg_price else Color.FAIL
-            print(f"€{invest_amount:<11,.0f} | {amount_bought:<12.6f} | {new_total_bought:<15.6f} | {color}€{new_avg_price:<14,.2f}{Color.ENDC} | {reduction:.2f}%")
-        
+        })
         plot_data.append((invest_amount, new_avg_price))
+    
+    if print_output:
+        print_dca_scenarios(dca_data)
         
     return plot_data, dca_data
 
-def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, output_dir='data'):
+# Loss/gain colors, indexed by a bool instead of branching per row
+PL_COLORS = (Color.FAIL, Color.GREEN)
+
+# Scenario table row, keyed by run_dca_scenarios() fields; PL_COLORS[new_avg < avg]
+DCA_ROW_TEMPLATE = (
+    f"€{{investment:<11,.0f}} | {{buy_amount:<12.6f}} | {{new_total_btc:<15.6f}} | "
+    f"{{color}}€{{new_avg_price:<14,.2f}}{Color.ENDC} | {{reduction_percent:.2f}}%"
+)
+
+def print_dca_scenarios(dca_data):
+    """Prints the scenario table built by run_dca_scenarios."""
+    avg_price = dca_data['current_avg_price']
+    print_colored(f"\n--- Scenario Analysis: Averaging Down {dca_data['asset']} ---", Color.CYAN)
+    print(f"Total BTC Bought:    {dca_data['total_bought']:,.6f} (This is the sum of all your 'Buy' orders)")
+    print(f"Total Cost Basis:    €{dca_data['total_cost']:,.2f}  (This is the sum of all EUR spent on those orders)")
+    print(f"Current Avg Price:   {Color.BOLD}€{avg_price:,.2f}{Color.ENDC}  (Cost Basis / Total Bought)")
+    print(f"Current Market Price: {Color.BOLD}€{dca_data['current_market_price']:,.2f}{Color.ENDC}")
+    
+    if dca_data['is_profit']:
+        print_colored("You are currently in profit on your historical buys. Averaging UP.", Color.GREEN)
+    else:
+        print_colored("You are currently in loss on your historical buys. Averaging DOWN.", Color.WARNING)
+
+    print("\nImpact of new purchases:")
+    print(f"{'Invest (€)':<12} | {'Buy Amount':<12} | {'New Total BTC':<15} | {'New Avg Price':<15} | {'Reduction %':<10}")
+    print("-" * 75)
+    
+    # The table is printed in one write
+    table_lines = [
+        DCA_ROW_TEMPLATE.format(color=PL_COLORS[s['new_avg_price'] < avg_price], **s)
+        for s in dca_data['scenarios']
+    ]
+    if table_lines:
+        print("\n".join(table_lines))
+
+# matplotlib is imported on the first chart call, so runs that draw no charts
+# never pay for it. Both are set by _load_matplotlib().
+plt = None
+CHART_STYLE = {} # dark_background, resolved once; applied per call through rc_context
+_MPL_AVAILABLE = None # None until the first import attempt
+
+def _load_matplotlib():
+    """Imports matplotlib (Agg backend) once; returns False when it is not installed."""
+    global plt, CHART_STYLE, _MPL_AVAILABLE
+    if _MPL_AVAILABLE is None:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as pyplot
+        except ImportError:
+            _MPL_AVAILABLE = False
+        else:
+            plt = pyplot
+            CHART_STYLE = {**plt.style.library['dark_background'], 'path.simplify_threshold': 1.0}
+            _MPL_AVAILABLE = True
+    return _MPL_AVAILABLE
+
+def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, output_dir='data', chart_dpi=None, summary_rows=None):
     """
     Generate two separate chart images:
     1. portfolio_summary.png - Pie, Bar, and Portfolio Table
     2. dca_analysis.png - Stats text, Line Chart, Scenario Table (only if BTC data exists)
     
-    Returns a list of generated file paths.
+    Returns a list of generated file paths, or of PNG bytes when output_dir
+    is None (charts are then rendered in memory and never touch the disk).
+
+    chart_dpi defaults to 90 in memory and 100 on disk; pass 150 for print quality.
+    summary_rows are summarize_holdings() rows; computed here when not given.
     """
-    try:
-        import matplotlib.pyplot as plt
-        import pandas as pd
-        from pandas.plotting import table as mpl_table
-    except ImportError:
-        print_colored("\nWarning: matplotlib or pandas not found. Skipping charts.", Color.WARNING)
+    if not _load_matplotlib():
+        print_colored("\nWarning: matplotlib not found. Skipping charts.", Color.WARNING)
         return []
 
-    os.makedirs(output_dir, exist_ok=True)
-    plt.style.use('dark_background')
-    chart_paths = []
+    if summary_rows is None:
+        held = tuple(sorted(a for a in portfolio_data if a not in FIAT_ASSETS))
+        summary_rows = summarize_holdings(portfolio_data, held, collections.defaultdict(float, prices))[0]
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    # Scoped to this call so the global rcParams are never touched
+    with plt.rc_context(CHART_STYLE):
+        return _render_charts(summary_rows, dca_data_btc, dca_summary, output_dir, chart_dpi)
+
+def _render_charts(summary_rows, dca_data_btc, dca_summary, output_dir, chart_dpi):
+    charts = []
+
+    # zlib level 1 encodes several times faster than the default (6) for a
+    # slightly larger PNG
+    png_kwargs = {'optimize': False, 'compress_level': 1}
+    if chart_dpi is None:
+        # In-memory charts go to Telegram, which downsizes photos to ~1280px anyway
+        chart_dpi = 90 if output_dir is None else 100
+
+    def save(fig, filename, label):
+        if output_dir is None:
+            buf = io.BytesIO()
+            fig.savefig(buf, format='png', dpi=chart_dpi, pil_kwargs=png_kwargs)
+            charts.append(buf.getvalue())
+        else:
+            path = os.path.abspath(os.path.join(output_dir, filename))
+            fig.savefig(path, dpi=chart_dpi, pil_kwargs=png_kwargs)
+            charts.append(path)
+            print_colored(f"{label} chart saved to {path}", Color.GREEN)
+        plt.close(fig)
 
     # --- Helper: Format Function ---
     def fmt(x, currency=True, decimals=2):
@@ -362,36 +682,28 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
     # ========================================================
     # IMAGE 1: Portfolio Summary
     # ========================================================
-    fig1 = plt.figure(figsize=(14, 14))
-    fig1.suptitle('📊 Portfolio Summary', fontsize=20, color='white', y=0.98)
-    grid1 = plt.GridSpec(2, 2, hspace=0.35, wspace=0.25, height_ratios=[1, 1.5])
+    fig1, axes1 = plt.subplot_mosaic([['pie', 'bar'], ['tbl', 'tbl']], figsize=(14, 14),
+                                     layout='constrained', height_ratios=[1, 1.5])
+    fig1.get_layout_engine().set(hspace=0.08, wspace=0.06)
+    fig1.suptitle('📊 Portfolio Summary', fontsize=20, color='white')
 
     # -- Pie Chart (Top Left) --
-    ax_pie = fig1.add_subplot(grid1[0, 0])
-    labels, values = [], []
-    for asset, data in portfolio_data.items():
-        if asset == 'EUR' or data['amount'] <= 0.0001: continue
-        price = prices.get(asset, 0)
-        value = data['amount'] * price
-        if value > 1.0:
-            labels.append(asset)
-            values.append(value)
+    ax_pie = axes1['pie']
+    # Pie and bar read the rows already valued by summarize_holdings
+    shown = [row for row in summary_rows if row['balance'] > 0.0001]
+    labels = [row['asset'] for row in shown if row['value'] > 1.0]
+    values = [row['value'] for row in shown if row['value'] > 1.0]
     if values:
         ax_pie.pie(values, labels=labels, autopct='%1.1f%%', startangle=140,
                    colors=plt.cm.Paired.colors, textprops={'color': 'w'})
         ax_pie.set_title('Value Distribution', fontsize=14)
 
     # -- Bar Chart (Top Right) --
-    ax_bar = fig1.add_subplot(grid1[0, 1])
-    bar_assets, bar_costs, bar_vals = [], [], []
-    for asset, data in portfolio_data.items():
-        if asset == 'EUR' or data['amount'] <= 0.0001: continue
-        price = prices.get(asset, 0)
-        val = data['amount'] * price
-        if val > 10.0:
-            bar_assets.append(asset)
-            bar_costs.append(data['buy_cost'])
-            bar_vals.append(val)
+    ax_bar = axes1['bar']
+    bars = [row for row in shown if row['value'] > 10.0]
+    bar_assets = [row['asset'] for row in bars]
+    bar_costs = [row['cost_basis'] for row in bars]
+    bar_vals = [row['value'] for row in bars]
     if bar_assets:
         x = range(len(bar_assets))
         w = 0.35
@@ -405,28 +717,21 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
         ax_bar.get_yaxis().set_major_formatter(plt.FuncFormatter(lambda x, p: f"€{int(x):,}"))
 
     # -- Portfolio Table (Bottom, spans both columns) --
-    ax_tbl = fig1.add_subplot(grid1[1, :])
+    ax_tbl = axes1['tbl']
     ax_tbl.axis('off')
     ax_tbl.set_title('Holdings Detail', fontsize=14, pad=10)
 
     tbl_rows = []
     total_val_sum, total_cost_sum = 0.0, 0.0
-    for asset in sorted(portfolio_data.keys()):
-        data = portfolio_data[asset]
-        if asset == 'EUR': continue
-        if data['amount'] < 0.000001 and data['withdrawn'] < 0.000001: continue
-        price = prices.get(asset, 0)
-        val = data['amount'] * price
-        cost = data['buy_cost']
-        pl = val - cost
-        total_val_sum += val
-        total_cost_sum += cost
+    for row in summary_rows:
+        total_val_sum += row['value']
+        total_cost_sum += row['cost_basis']
         tbl_rows.append([
-            asset,
-            fmt(data['amount'], False, 5),
-            fmt(price), fmt(val), fmt(cost), fmt(pl),
-            fmt(data['rewards'], False, 5),
-            fmt(data['withdrawn'], False, 5)
+            row['asset'],
+            fmt(row['balance'], False, 5),
+            fmt(row['price']), fmt(row['value']), fmt(row['cost_basis']), fmt(row['pl_euro']),
+            fmt(row['rewards'], False, 5),
+            fmt(row['withdrawn'], False, 5)
         ])
 
     # Add totals row
@@ -437,10 +742,10 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
         '', ''
     ])
 
-    df = pd.DataFrame(tbl_rows, columns=['Asset', 'Balance', 'Price', 'Value', 'Cost', 'P/L', 'Rewards', 'Wallet'])
-    if not df.empty:
-        t = mpl_table(ax_tbl, df, loc='center', cellLoc='center',
-                      colWidths=[0.08, 0.14, 0.12, 0.12, 0.12, 0.12, 0.14, 0.14])
+    if tbl_rows:
+        t = ax_tbl.table(cellText=tbl_rows, colLabels=['Asset', 'Balance', 'Price', 'Value', 'Cost', 'P/L', 'Rewards', 'Wallet'],
+                         loc='center', cellLoc='center',
+                         colWidths=[0.08, 0.14, 0.12, 0.12, 0.12, 0.12, 0.14, 0.14])
         t.auto_set_font_size(False)
         t.set_fontsize(10)
         t.scale(1.1, 1.8)
@@ -464,23 +769,18 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
                             cell.set_text_props(color='#ff6b6b', weight='bold')
                     except: pass
 
-    fig1.tight_layout(rect=[0, 0, 1, 0.96])
-    path1 = os.path.join(output_dir, 'portfolio_summary.png')
-    fig1.savefig(path1, dpi=150, bbox_inches='tight')
-    plt.close(fig1)
-    chart_paths.append(os.path.abspath(path1))
-    print_colored(f"Portfolio chart saved to {os.path.abspath(path1)}", Color.GREEN)
+    save(fig1, 'portfolio_summary.png', 'Portfolio')
 
     # ========================================================
     # IMAGE 2: DCA Analysis (only if BTC data)
     # ========================================================
     if dca_data_btc and dca_summary:
-        fig2 = plt.figure(figsize=(12, 14))
-        fig2.suptitle('📉 DCA Scenario Analysis: BTC', fontsize=20, color='white', y=0.98)
-        grid2 = plt.GridSpec(3, 1, hspace=0.4, height_ratios=[0.8, 1.5, 1])
+        fig2, (ax_stats, ax_line, ax_dca_tbl) = plt.subplots(3, 1, figsize=(12, 14), layout='constrained',
+                                                             height_ratios=[0.8, 1.5, 1])
+        fig2.get_layout_engine().set(hspace=0.1)
+        fig2.suptitle('📉 DCA Scenario Analysis: BTC', fontsize=20, color='white')
 
         # -- Row 1: Stats Text Box --
-        ax_stats = fig2.add_subplot(grid2[0])
         ax_stats.axis('off')
 
         status_text = "Averaging UP ▲" if dca_summary['is_profit'] else "Averaging DOWN ▼"
@@ -504,7 +804,6 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
                       ha='center', va='center')
 
         # -- Row 2: Line Chart --
-        ax_line = fig2.add_subplot(grid2[1])
         investments, new_prices = zip(*dca_data_btc)
         ax_line.plot(investments, new_prices, marker='o', linestyle='-', color='#339af0', linewidth=2.5, markersize=8)
         current_avg = new_prices[0]
@@ -521,7 +820,6 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
                              textcoords="offset points", xytext=(0, 12), ha='center', color='white', fontsize=9)
 
         # -- Row 3: Scenario Table --
-        ax_dca_tbl = fig2.add_subplot(grid2[2])
         ax_dca_tbl.axis('off')
         ax_dca_tbl.set_title('Scenario Breakdown', fontsize=14, pad=10)
 
@@ -537,10 +835,10 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
                 f"{reduction:.2f}%"
             ])
 
-        df_dca = pd.DataFrame(dca_rows, columns=['Invest', 'Buy Amt', 'New Total', 'New Avg Price', 'Reduction'])
-        if not df_dca.empty:
-            t2 = mpl_table(ax_dca_tbl, df_dca, loc='center', cellLoc='center',
-                           colWidths=[0.15, 0.18, 0.18, 0.18, 0.15])
+        if dca_rows:
+            t2 = ax_dca_tbl.table(cellText=dca_rows, colLabels=['Invest', 'Buy Amt', 'New Total', 'New Avg Price', 'Reduction'],
+                                  loc='center', cellLoc='center',
+                                  colWidths=[0.15, 0.18, 0.18, 0.18, 0.15])
             t2.auto_set_font_size(False)
             t2.set_fontsize(11)
             t2.scale(1, 1.8)
@@ -553,14 +851,9 @@ def generate_charts(portfolio_data, dca_data_btc, prices, dca_summary=None, outp
                     cell.set_facecolor('none')
                     cell.set_text_props(color='white')
 
-        fig2.tight_layout(rect=[0, 0, 1, 0.96])
-        path2 = os.path.join(output_dir, 'dca_analysis.png')
-        fig2.savefig(path2, dpi=150, bbox_inches='tight')
-        plt.close(fig2)
-        chart_paths.append(os.path.abspath(path2))
-        print_colored(f"DCA chart saved to {os.path.abspath(path2)}", Color.GREEN)
+        save(fig2, 'dca_analysis.png', 'DCA')
 
-    return chart_paths
+    return charts
 
 def print_glossary():
     glossary = (
@@ -588,7 +881,7 @@ def load_wallet_csv(filepath):
     """Loads receiver transactions from a wallet CSV."""
     txs = []
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
+        with open(filepath, 'r', encoding='utf-8-sig') as f:
             reader = csv.DictReader(f)
             for row in reader:
                 try:
@@ -607,56 +900,66 @@ def load_wallet_csv(filepath):
         print_colored(f"Error reading wallet CSV: {e}", Color.WARNING)
     return txs
 
+def _to_sats(amount):
+    return int(round(amount * 1e8))
+
+# Satoshi windows (inclusive) a wallet amount may fall in to match a withdrawal of k sats:
+# 1. Exact match
+# 2./3. Net of a standard Kraken BTC fee (0.00001 / 0.00002), within 0.000001.
+#    If ledger amount is gross, wallet receives net.
+MATCH_WINDOWS = ((0, 0), (-1099, -901), (-2099, -1901))
+
+def _index_wallet_txs(wallet_txs):
+    """Bucket unclaimed wallet txs by satoshi amount, each bucket in wallet order."""
+    index = collections.defaultdict(list)
+    for pos, wt in enumerate(wallet_txs):
+        if not wt['found']:
+            index[_to_sats(wt['amount'])].append((pos, wt))
+    return index, sorted(index)
+
+def _claim_wallet_match(index, keys, k_sats):
+    """Pop the earliest (in wallet order) unclaimed tx inside any MATCH_WINDOWS range."""
+    best_key = None
+    for lo, hi in MATCH_WINDOWS:
+        i = bisect.bisect_left(keys, k_sats + lo)
+        while i < len(keys) and keys[i] <= k_sats + hi:
+            bucket = index[keys[i]]
+            if bucket and (best_key is None or bucket[0][0] < index[best_key][0][0]):
+                best_key = keys[i]
+            i += 1
+    if best_key is None:
+        return None
+    return index[best_key].pop(0)[1]
+
+_get_amount = attrgetter('amount')
+_get_wallet_amount = itemgetter('amount')
+
 def verify_withdrawals(kraken_txs, wallet_txs, print_output=True):
     """Checks if Kraken BTC withdrawals appear in the Wallet CSV."""
     
     # Filter Kraken BTC Withdrawals
     kraken_withdrawals = [t for t in kraken_txs if t.asset == 'BTC' and t.type == 'withdrawal']
+    wallet_index, wallet_keys = _index_wallet_txs(wallet_txs)
     
     verification_results = {
+        'withdrawals': [], # every Kraken withdrawal, matched or not
         'matches': [],
         'orphans': [],
         'totals': {}
     }
     
-    if print_output:
-        print_colored(f"\n=== 🛡️ WALLET VERIFICATION ===", Color.HEADER)
-        print(f"{'Kraken Date':<20} | {'Amount (BTC)':<14} | {'Status':<20} | {'Wallet Match'}")
-        print("-" * 80)
-    
     for kt in kraken_withdrawals:
         k_amount = abs(kt.amount)
-        status = "Not Found ❌"
-        status_color = Color.FAIL
-        match_info = ""
         
-        # Look for a match in wallet_txs
-        best_match = None
-        for wt in wallet_txs:
-            if wt['found']: continue 
-            
-            # 1. Exact match
-            diff = abs(wt['amount'] - k_amount)
-            if diff < 0.00000001: 
-                best_match = wt
-                break
-            
-            # 2. Match with fee (sometimes Kraken withdrawal fee is deducted from amount or separate)
-            # Standard Kraken BTC fee is 0.00001 or similar. 
-            # Let's verify against common fee subtracted: amount - 0.00001 
-            # But here k_amount is from ledger. Ledger usually shows [ -Amount ] [ -Fee ].
-            # If ledger amount is gross, wallet receives net. 
-            if abs(wt['amount'] - (k_amount - 0.00001)) < 0.000001:
-                 best_match = wt
-                 break
-            if abs(wt['amount'] - (k_amount - 0.00002)) < 0.000001:
-                 best_match = wt
-                 break
+        # Look for a match in wallet_txs: earliest unclaimed entry in any window
+        best_match = _claim_wallet_match(wallet_index, wallet_keys, _to_sats(k_amount))
+        verification_results['withdrawals'].append({
+            'kraken_date': kt.time,
+            'amount': k_amount,
+            'wallet_match': best_match
+        })
                  
         if best_match:
-            status = "Verified ✅"
-            status_color = Color.GREEN
-            match_info = f"Found: {best_match['amount']} on {best_match['date']}"
             best_match['found'] = True 
             
             verification_results['matches'].append({
@@ -665,37 +968,60 @@ def verify_withdrawals(kraken_txs, wallet_txs, print_output=True):
                 'wallet_date': best_match['date'],
                 'wallet_amount': best_match['amount']
             })
-        
-        if print_output:
-            print(f"{kt.time:<20} | {k_amount:<14.8f} | {status_color}{status:<20}{Color.ENDC} | {match_info}")
 
     # --- Totals Reconciliation ---
-    total_kraken_out = sum(abs(t.amount) for t in kraken_withdrawals)
-    total_wallet_in = sum(t['amount'] for t in wallet_txs)
-    diff = total_wallet_in - total_kraken_out
+    total_kraken_out = sum(map(abs, map(_get_amount, kraken_withdrawals)))
+    total_wallet_in = sum(map(_get_wallet_amount, wallet_txs))
     
     verification_results['totals'] = {
         'kraken_out': total_kraken_out,
         'wallet_in': total_wallet_in,
-        'diff': diff
+        'diff': total_wallet_in - total_kraken_out
     }
+
+    # --- Orphan Wallet Transactions ---
+    verification_results['orphans'] = [t for t in wallet_txs if not t['found']]
     
     if print_output:
-        print("-" * 80)
-        print(f"{'TOTALS':<20} | {'Kraken Out':<14} | {'Wallet In':<14} | {'Difference'}")
-        print(f"{'':<20} | {total_kraken_out:<14.8f} | {total_wallet_in:<14.8f} | {diff:+.8f}")
+        print_verification(verification_results)
         
-        if abs(diff) > 0.0001:
-            print_colored(f"\n⚠️ Mismatch Detected: {diff:+.8f} BTC", Color.WARNING)
-            print("Possible reasons:\n1. Missing Kraken transactions (e.g. older history not exported).\n2. Deposits from other sources (not Kraken).\n3. Fees deducted differently.")
-        else:
-            print_colored("\n✅ Totals Match perfectly!", Color.GREEN)
+    return verification_results
 
-    # --- Orphan Wallet Transactions ---
-    orphans = [t for t in wallet_txs if not t['found']]
-    verification_results['orphans'] = orphans
+# Padded, colored status cell per withdrawal, indexed by whether a wallet match was found
+VERIFY_STATUS = (
+    f"{Color.FAIL}{'Not Found ❌':<20}{Color.ENDC}",
+    f"{Color.GREEN}{'Verified ✅':<20}{Color.ENDC}",
+)
+
+def print_verification(verification_results):
+    """Prints the withdrawal-by-withdrawal table, totals and orphans from verify_withdrawals."""
+    print_colored(f"\n=== 🛡️ WALLET VERIFICATION ===", Color.HEADER)
+    print(f"{'Kraken Date':<20} | {'Amount (BTC)':<14} | {'Status':<20} | {'Wallet Match'}")
+    print("-" * 80)
+    
+    # The table is printed in one write
+    table_lines = []
+    for w in verification_results['withdrawals']:
+        match = w['wallet_match']
+        match_info = f"Found: {match['amount']} on {match['date']}" if match else ""
+        table_lines.append(f"{w['kraken_date']:<20} | {w['amount']:<14.8f} | {VERIFY_STATUS[bool(match)]} | {match_info}")
+    if table_lines:
+        print("\n".join(table_lines))
+
+    totals = verification_results['totals']
+    diff = totals['diff']
+    print("-" * 80)
+    print(f"{'TOTALS':<20} | {'Kraken Out':<14} | {'Wallet In':<14} | {'Difference'}")
+    print(f"{'':<20} | {totals['kraken_out']:<14.8f} | {totals['wallet_in']:<14.8f} | {diff:+.8f}")
     
-    if print_output and orphans:
+    if abs(diff) > 0.0001:
+        print_colored(f"\n⚠️ Mismatch Detected: {diff:+.8f} BTC", Color.WARNING)
+        print("Possible reasons:\n1. Missing Kraken transactions (e.g. older history not exported).\n2. Deposits from other sources (not Kraken).\n3. Fees deducted differently.")
+    else:
+        print_colored("\n✅ Totals Match perfectly!", Color.GREEN)
+
+    orphans = verification_results['orphans']
+    if orphans:
         print_colored(f"\n⚠️ FOUND IN WALLET BUT NOT IN KRAKEN ({len(orphans)}):", Color.WARNING)
         print(f"{'Wallet Date':<20} | {'Amount (BTC)':<14}")
         print("-" * 40)
@@ -703,43 +1029,33 @@ def verify_withdrawals(kraken_txs, wallet_txs, print_output=True):
              print(f"{t['date']:<20} | {t['amount']:<14.8f}")
              
         print_colored("These transactions account for the difference shown above.", Color.CYAN)
-        
-    return verification_results
 
-def generate_analysis_report(ledger_path, wallet_path=None, output_dir='data'):
+def _verify_wallet_file(transactions, wallet_path):
+    """Loads the wallet CSV and matches it against the ledger, without printing."""
+    return verify_withdrawals(transactions, load_wallet_csv(wallet_path), print_output=False)
+
+DUST_THRESHOLD = 1e-6 # balances and withdrawals below this are dust and left out of the summary
+
+def summarize_holdings(portfolio, assets_held, prices):
     """
-    Analyzes the portfolio and returns a dictionary with all data.
-    Used by both CLI and Bot.
+    One pass over the held assets (already sorted by analyze_portfolio): per-asset
+    rows (dust skipped) plus total value and cost. Shared by the report, the CLI table and the charts.
+    prices is a defaultdict(float): an asset without a price is valued at 0.0.
     """
-    report = {}
-    
-    # 1. Load Data
-    transactions = load_csv(ledger_path)
-    report['transactions_count'] = len(transactions)
-    
-    # 2. Process Portfolio
-    portfolio = analyze_portfolio(transactions)
-    
-    # 3. Fetch Prices
-    assets_held = [a for a, d in portfolio.items() if (d['amount'] > 0 or d['withdrawn'] > 0) and a not in FIAT_ASSETS]
-    prices = get_crypto_prices(assets_held)
-    
-    # 4. Build Summary Data
     summary_data = []
     total_value = 0.0
     total_cost = 0.0
-    dca_btc_data = []
     
-    for asset in sorted(assets_held):
+    for asset in assets_held:
         data = portfolio[asset]
-        balance = data['amount']
-        withdrawn = data['withdrawn']
+        balance = data.amount
+        withdrawn = data.withdrawn
         
-        if balance < 0.000001 and withdrawn < 0.000001: continue
+        if max(balance, withdrawn) < DUST_THRESHOLD: continue
         
-        current_price = prices.get(asset, 0)
+        current_price = prices[asset]
         current_value = balance * current_price
-        cost_basis = data['buy_cost']
+        cost_basis = data.buy_cost
         pl_euro = current_value - cost_basis
         
         asset_info = {
@@ -749,46 +1065,110 @@ def generate_analysis_report(ledger_path, wallet_path=None, output_dir='data'):
             'value': current_value,
             'cost_basis': cost_basis,
             'pl_euro': pl_euro,
-            'rewards': data['rewards'],
+            'rewards': data.rewards,
             'withdrawn': withdrawn
         }
         summary_data.append(asset_info)
         
         total_value += current_value
         total_cost += cost_basis
-        
-        # Calculate DCA data for BTC but don't print
-        if asset == 'BTC' and current_price > 0:
-              pass
- 
-    report['portfolio'] = summary_data
-    report['total_value'] = total_value
-    report['total_cost'] = total_cost
-    report['net_pl'] = total_value - total_cost
-    
-    # 5. Charts
-    btc_data = portfolio['BTC']
-    btc_price = prices.get('BTC', 0)
-    dca_plot_data = []
-    dca_summary = None
-    
-    if btc_price > 0:
-        dca_plot_data, dca_summary = run_dca_scenarios('BTC', btc_data['amount'], btc_data['buy_cost'], btc_data['buy_amt'], btc_price, print_output=False)
-        report['dca_analysis'] = dca_summary
-    else:
-        report['dca_analysis'] = None
+
+    return summary_data, total_value, total_cost
+
+def generate_analysis_report(ledger_path, wallet_path=None, output_dir='data', chart_dpi=None, charts=True):
+    """
+    Analyzes the portfolio and returns a dictionary with all data.
+    Used by both CLI and Bot.
+    
+    Charts are saved under output_dir ('chart_paths'), or returned as PNG
+    bytes ('chart_images') when output_dir is None. charts=False skips them
+    (and the matplotlib import) entirely.
+    """
+    report = {}
     
-    # Save charts (returns list of paths)
-    chart_paths = generate_charts(portfolio, dca_plot_data, prices, dca_summary=dca_summary, output_dir=output_dir)
-    report['chart_paths'] = chart_paths
+    # 1. Load Data
+    transactions = load_csv(ledger_path)
+    report['transactions_count'] = len(transactions)
+    
+    # 2. Process Portfolio
+    portfolio, assets_held = analyze_portfolio(transactions)
     
-    # 6. Wallet Verification
-    if wallet_path and os.path.exists(wallet_path):
-        wallet_txs = load_wallet_csv(wallet_path)
-        report['wallet_verification'] = verify_withdrawals(transactions, wallet_txs, print_output=False)
+    # 3. Fetch Prices and verify the wallet in the background: neither depends on
+    # the other, and the wallet check keeps running while charts are drawn below.
+    # Charts stay on this thread (pyplot is not thread-safe).
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        price_future = pool.submit(get_crypto_prices, assets_held)
+        verify_future = None
+        if wallet_path and os.path.exists(wallet_path):
+            verify_future = pool.submit(_verify_wallet_file, transactions, wallet_path)
+        # Missing price = 0.0, settled once here for every lookup below
+        prices = collections.defaultdict(float, price_future.result())
+    
+        # 4. Build Summary Data
+        summary_data, total_value, total_cost = summarize_holdings(portfolio, assets_held, prices)
+     
+        report['portfolio'] = summary_data
+        report['total_value'] = total_value
+        report['total_cost'] = total_cost
+        report['net_pl'] = total_value - total_cost
+        
+        # 5. Charts
+        btc_data = portfolio.get('BTC')
+        btc_price = prices['BTC']
+        dca_plot_data = []
+        dca_summary = None
+        
+        # Scenarios need an average buy price: skip when BTC was never bought
+        if btc_price > 0 and btc_data is not None and btc_data.buy_amt > 0:
+            dca_plot_data, dca_summary = run_dca_scenarios('BTC', btc_data.amount, btc_data.buy_cost, btc_data.buy_amt, btc_price, print_output=False)
+            report['dca_analysis'] = dca_summary
+        else:
+            report['dca_analysis'] = None
+        
+        # Save charts (returns list of paths, or PNG bytes when rendered in memory)
+        report['chart_paths'] = []
+        report['chart_images'] = []
+        if charts:
+            rendered = generate_charts(portfolio, dca_plot_data, prices, dca_summary=dca_summary, output_dir=output_dir,
+                                       chart_dpi=chart_dpi, summary_rows=summary_data)
+            report['chart_images' if output_dir is None else 'chart_paths'] = rendered
+        
+        # 6. Wallet Verification
+        if verify_future is not None:
+            report['wallet_verification'] = verify_future.result()
         
     return report
 
+# Holdings table row, keyed by summarize_holdings() fields; PL_COLORS[pl >= 0]
+SUMMARY_ROW_TEMPLATE = (
+    f"{Color.BOLD}{{asset:<6}}{Color.ENDC} | {{balance:<12.5f}} | {{price:<10.2f}} | {{value:<12.2f}} | "
+    f"{{cost_basis:<12.2f}} | {{pl_color}}{{pl_euro:<10.2f}}{Color.ENDC} | {{rewards:<10.5f}} | {{withdrawn:<12.5f}}"
+)
+
+def print_portfolio_summary(report):
+    """Prints the holdings table and totals from a generate_analysis_report result."""
+    # Built as one string and written once, rather than a print() per line
+    lines = [
+        f"{Color.HEADER}\n=== PORTFOLIO SUMMARY ==={Color.ENDC}",
+        f"{'Asset':<6} | {'Balance':<12} | {'Price (€)':<10} | {'Value (€)':<12} | {'Cost Basis':<12} | {'P/L (€)':<10} | {'Rewards':<10} | {'Wallet':<12}",
+        "-" * 105,
+    ]
+    lines.extend(
+        SUMMARY_ROW_TEMPLATE.format(pl_color=PL_COLORS[row['pl_euro'] >= 0], **row)
+        for row in report['portfolio']
+    )
+
+    net = report['net_pl']
+    net_c = Color.GREEN if net >= 0 else Color.FAIL
+    lines += [
+        "-" * 105,
+        f"Total Portfolio Value: {Color.BOLD}€{report['total_value']:,.2f}{Color.ENDC}",
+        f"Total Cost Basis:      €{report['total_cost']:,.2f}",
+        f"Net P/L:               {net_c}€{net:,.2f}{Color.ENDC}",
+        "",
+    ]
+    sys.stdout.write("\n".join(lines))
+
 # --- Main Execution ---
 if __name__ == "__main__":
     import argparse
@@ -796,70 +1176,24 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Analyze Kraken Portfolio and Verify Trezor Wallet.')
     parser.add_argument('ledger', help='Path to Kraken Ledger CSV')
     parser.add_argument('--wallet', help='Path to Trezor Wallet CSV (optional)', default=None)
+    parser.add_argument('--no-charts', help='Skip chart images (and loading matplotlib)', action='store_true')
     
     args = parser.parse_args()
     
     print_colored(f"Analyzing {args.ledger}...", Color.HEADER)
     
-    # 1. Load Data
-    transactions = load_csv(args.ledger)
-    
-    # 2. Process
-    portfolio = analyze_portfolio(transactions)
-    
-    # 3. Prices
-    print("Fetching current market prices...")
-    assets_held = [a for a, d in portfolio.items() if (d['amount'] > 0 or d['withdrawn'] > 0) and a not in FIAT_ASSETS]
-    prices = get_crypto_prices(assets_held)
-    
-    # 4. Print Report (Manual Printing for CLI fidelity)
-    print_colored("\n=== PORTFOLIO SUMMARY ===", Color.HEADER)
-    print(f"{'Asset':<6} | {'Balance':<12} | {'Price (€)':<10} | {'Value (€)':<12} | {'Cost Basis':<12} | {'P/L (€)':<10} | {'Rewards':<10} | {'Wallet':<12}")
-    print("-" * 105)
-    
-    total_val = 0
-    total_cost = 0
-    dca_btc = []
-    
-    for asset in sorted(assets_held):
-        data = portfolio[asset]
-        if data['amount'] < 0.000001 and data['withdrawn'] < 0.000001: continue
-        
-        price = prices.get(asset, 0)
-        val = data['amount'] * price
-        cost = data['buy_cost']
-        pl = val - cost
-        
-        total_val += val
-        total_cost += cost
-        
-        pl_color = Color.GREEN if pl >= 0 else Color.FAIL
-        print(f"{Color.BOLD}{asset:<6}{Color.ENDC} | {data['amount']:<12.5f} | {price:<10.2f} | {val:<12.2f} | {cost:<12.2f} | {pl_color}{pl:<10.2f}{Color.ENDC} | {data['rewards']:<10.5f} | {data['withdrawn']:<12.5f}")
-        
-        if asset == 'BTC' and price > 0:
-            dca_btc = run_dca_scenarios(asset, data['amount'], cost, data['buy_amt'], price)
-
-    print("-" * 105)
-    print(f"Total Portfolio Value: {Color.BOLD}€{total_val:,.2f}{Color.ENDC}")
-    print(f"Total Cost Basis:      €{total_cost:,.2f}")
-    net = total_val - total_cost
-    net_c = Color.GREEN if net >= 0 else Color.FAIL
-    print(f"Net P/L:               {net_c}€{net:,.2f}{Color.ENDC}")
-
-    # 5. Charts
-    print_colored("\nGenerating Charts...", Color.BLUE)
-    generate_charts(portfolio, dca_btc, prices)
+    # Load, analyze, fetch prices, run DCA, draw charts and verify in one pass
+    try:
+        report = generate_analysis_report(args.ledger, args.wallet, charts=not args.no_charts)
+    except FileNotFoundError as e:
+        print_colored(f"Error: File '{e.filename or args.ledger}' not found.", Color.FAIL)
+        sys.exit(1)
     
-    # 6. Glossary
+    print_portfolio_summary(report)
+    if report['dca_analysis']:
+        print_dca_scenarios(report['dca_analysis'])
     print_glossary()
-    
-    # 7. Wallet Verification
-    if args.wallet and os.path.exists(args.wallet):
-        wallet_txs = load_wallet_csv(args.wallet)
-        verify_withdrawals(transactions, wallet_txs, print_output=True)
+    if report.get('wallet_verification'):
+        print_verification(report['wallet_verification'])
 
     print("\nDone.")
-
-
-
-